@@ -1,29 +1,44 @@
+import hashlib
+import html
+import math
 import os
-import re
 import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass, field
 from datetime import date, datetime, UTC
+from functools import lru_cache
 from pathlib import Path
+from urllib.parse import unquote
 
 import click
-from jinja2 import Environment, FileSystemLoader
 from mistune import create_markdown
 from mistune.directives import RSTDirective, TableOfContents
 from mistune.plugins.formatting import strikethrough, superscript
 from mistune.plugins.table import table
 from mistune.renderers.html import HTMLRenderer
 from mistune.util import escape, safe_entity, striptags
-from PIL import Image
-from slugify import slugify
-from yaml import safe_load
+from yaml import load
 
-RE_FRONTMATTER = re.compile(
-    r"^((-{3,})\n(?P<custom>.*?)\n(-{3,})\n)?(?P<content>.*)$", re.DOTALL
-)
-RE_EXTRACT_IMAGES = re.compile(r"!\[.*?]\((?P<filename>.*?)\)")
+try:
+    from fcntl import FICLONE, ioctl
+except ImportError:  # not Linux or Python < 3.12
+    FICLONE = None
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader
 
-@dataclass
+EPOCH = datetime(1970, 1, 1, 0, 0, tzinfo=UTC)
+
+# method 4 balances encoding speed against file size, metadata is not written
+WEBP_OPTIONS = {"quality": 90, "method": 4}
+
+# bump whenever thumbnail sizes, resizing, cropping or conversion change
+THUMBNAIL_CACHE_VERSION = 1
+
+
+@dataclass(slots=True)
 class Site:
     name: str = ""
     author: str = ""
@@ -31,7 +46,7 @@ class Site:
     pages: list = field(default_factory=list)
 
 
-@dataclass
+@dataclass(slots=True)
 class Page:
     # from contents.yml
     url: str = ""
@@ -52,60 +67,97 @@ class Page:
 class CustomRenderer(HTMLRenderer):
     def link(self, text, url, title=None):
         # added rel and target
-        s = '<a href="' + self.safe_url(url) + '"'
-        if title:
-            s += ' title="' + safe_entity(title) + '"'
-        if "://" in url:
-            s += ' rel="noopener" target="_blank"'
-        return s + ">" + text + "</a>"
+        title_attr = f' title="{safe_entity(title)}"' if title else ""
+        external_attrs = ' rel="noopener" target="_blank"' if "://" in url else ""
+        return f'<a href="{self.safe_url(url)}"{title_attr}{external_attrs}>{text}</a>'
 
     def image(self, text, url, title=None):
         # added srcset and loading, wrapped into clickable figure with figcaption
         url = self.safe_url(url)
         stem, ext = os.path.splitext(url)
         alt = striptags(text)
-        s = '<img src="' + stem + '-w1024.webp" alt="' + alt + '"'
-        s += ' title="' + safe_entity(title or alt) + '"'
-        s += ' loading="lazy" />'
-        s = self.link(s, stem + '.webp')
-        return "</p><figure>" + s + "<figcaption>" + alt + "</figcaption></figure><p>"
+        s = (
+            f'<img src="{stem}-w1024.webp" alt="{alt}"'
+            f' title="{safe_entity(title or alt)}" loading="lazy" />'
+        )
+        s = self.link(s, f"{stem}.webp")
+        return f"</p><figure>{s}<figcaption>{alt}</figcaption></figure><p>"
 
     def table(self, text):
-        return '<div class="table-wrapper"><table>' + text + "</table></div>"
+        return f'<div class="table-wrapper"><table>{text}</table></div>'
 
 
 class CustomTableOfContents(TableOfContents):
     def generate_heading_id(self, token, index):
+        from slugify import slugify
+
         return slugify(token["text"])
 
 
-def get_template(template_file):
-    env = Environment(
-        loader=FileSystemLoader(template_file.parent),
+@lru_cache(maxsize=None)
+def get_environment(templates_dir):
+    from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+    return Environment(
+        loader=FileSystemLoader(templates_dir),
         lstrip_blocks=True,
         trim_blocks=True,
+        auto_reload=False,
+        bytecode_cache=FileSystemBytecodeCache(),
     )
+
+
+def get_template(template_file):
+    env = get_environment(template_file.parent)
     tpl = env.get_template(template_file.name)
     return tpl
 
 
+def copy_file(src, dst):
+    # try a copy-on-write clone first, it's instant on btrfs and xfs
+    if FICLONE is not None:
+        try:
+            with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+                ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            pass
+
+    return shutil.copy2(src, dst)
+
+
 def copy_source_to_target(source_dir, target_dir):
     shutil.rmtree(target_dir)
-    shutil.copytree(source_dir, target_dir)
+    shutil.copytree(source_dir, target_dir, copy_function=copy_file)
+
+
+def safe_load(stream):
+    return load(stream, Loader=SafeLoader)
 
 
 def collect_frontmatter(raw_content):
-    match = RE_FRONTMATTER.match(raw_content)
+    custom = {}
+    content = raw_content
 
-    custom = match.group("custom") or ""
-    custom = safe_load(custom) or {}
-    content = match.group("content")
+    if raw_content.startswith("---\n"):
+        end = raw_content.find("\n---\n", 3)
+        if end >= 0:
+            custom = safe_load(raw_content[4:end]) or {}
+            content = raw_content[end + 5 :]
 
     return {"custom": custom, "content": content}
 
 
+def read_page_source(src):
+    try:
+        return src.read_text(encoding="utf-8")
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        return None
+
+
 def parse_config(target_dir, config_file):
-    with open(config_file) as config:
+    with open(config_file, encoding="utf-8") as config:
         site = safe_load(config)
 
     site = Site(**site)
@@ -117,22 +169,24 @@ def parse_config(target_dir, config_file):
             src = path.with_suffix(".md")
         else:
             src = path / "index.md"
-        page_data["src"] = src if src.is_file() else None
+        page_data["src"] = src
+
+    # reads are blocking I/O, overlap them
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        contents = executor.map(read_page_source, [p["src"] for p in pages])
+
+        for page_data, content in zip(pages, contents):
+            if content is None:
+                page_data["src"] = None
+                continue
 
-        if page_data["src"]:
             page_data["dst"] = page_data["src"].with_suffix(".html")
 
-            with open(page_data["src"], "r") as src:
-                content = src.read()
-                frontmatter_and_content = collect_frontmatter(content)
-                page_data.update(**frontmatter_and_content)
+            frontmatter_and_content = collect_frontmatter(content)
+            page_data.update(**frontmatter_and_content)
 
     pages = [Page(**p) for p in pages]
-    pages = sorted(
-        pages,
-        key=lambda p: p.date or datetime(1970, 1, 1, 0, 0, tzinfo=UTC),
-        reverse=True,
-    )
+    pages.sort(key=lambda p: p.date or EPOCH, reverse=True)
     site.pages = pages
 
     return site
@@ -162,30 +216,132 @@ def calculate_crop(image, gravity):
     return crop
 
 
-def generate_article_thumbnails(image_file):
-    with Image.open(image_file) as img:
-        img.thumbnail((min(img.width, 1920), 9999))
-        img.save(image_file.parent / f"{image_file.stem}.webp", quality=90)
-        img.thumbnail((1024, 9999))
-        img.save(image_file.parent / f"{image_file.stem}-w1024.webp", quality=90)
+def fit_width(image, width):
+    # bounding box keeping the aspect ratio, so Pillow can shrink JPEGs while decoding
+    width = min(image.width, width)
+    return width, math.ceil(image.height * width / image.width)
+
+
+def convert_for_webp(image):
+    # the encoder would otherwise convert other modes again on every save
+    if image.mode in ("RGB", "RGBA"):
+        return image
+    return image.convert("RGBA" if image.has_transparency_data else "RGB")
+
+
+def get_cache_key(image_file, *params):
+    digest = hashlib.sha1(image_file.read_bytes())
+    digest.update(repr((THUMBNAIL_CACHE_VERSION, params, WEBP_OPTIONS)).encode())
+    return digest.hexdigest()
+
+
+def restore_thumbnails(cache_dir, key, thumbnails):
+    cached_files = {
+        cache_dir / f"{key}{suffix}.webp": file for suffix, file in thumbnails.items()
+    }
+    if not all(cached_file.is_file() for cached_file in cached_files):
+        return False
+
+    for cached_file, file in cached_files.items():
+        copy_file(cached_file, file)
+
+    return True
+
+
+def store_thumbnails(cache_dir, key, thumbnails):
+    for suffix, file in thumbnails.items():
+        # copy under a temporary name, an interrupted build must not leave a bad entry
+        cached_file = cache_dir / f"{key}{suffix}.webp"
+        temp_file = cached_file.with_name(f"{cached_file.name}.{os.getpid()}.tmp")
+        copy_file(file, temp_file)
+        temp_file.replace(cached_file)
+
+
+def prune_thumbnail_cache(cache_dir, used_keys):
+    # drop entries of images that were edited or removed, and leftover temporary files
+    for cached_file in cache_dir.iterdir():
+        key = cached_file.name.partition("-")[0].partition(".")[0]
+        if key not in used_keys or cached_file.suffix == ".tmp":
+            cached_file.unlink()
+
+
+def generate_article_thumbnails(image_file, cache_dir):
+    from PIL import Image
+
+    key = get_cache_key(image_file, "article")
+    thumbnails = {
+        "": image_file.parent / f"{image_file.stem}.webp",
+        "-w1024": image_file.parent / f"{image_file.stem}-w1024.webp",
+    }
+
+    if not restore_thumbnails(cache_dir, key, thumbnails):
+        with Image.open(image_file) as img:
+            img.thumbnail(fit_width(img, 1920))
+            img = convert_for_webp(img)
+            img.save(thumbnails[""], **WEBP_OPTIONS)
+            img.thumbnail(fit_width(img, 1024))
+            img.save(thumbnails["-w1024"], **WEBP_OPTIONS)
+
+        store_thumbnails(cache_dir, key, thumbnails)
 
     image_file.unlink()
 
+    return key
+
+
+
+def generate_banner_thumbnails(image_file, gravity, cache_dir):
+    from PIL import Image
 
+    key = get_cache_key(image_file, "banner", gravity)
+    thumbnails = {
+        "": image_file.parent / f"{image_file.stem}.webp",
+        "-w720": image_file.parent / f"{image_file.stem}-w720.webp",
+    }
 
-def generate_banner_thumbnails(image_file, gravity):
-    with Image.open(image_file) as img:
-        img.thumbnail((min(img.width, 1920), 9999))
-        img.save(image_file.parent / f"{image_file.stem}.webp", quality=90)
-        img = img.crop(calculate_crop(img, gravity))
-        img.thumbnail((720, 720))
-        img.save(image_file.parent / f"{image_file.stem}-w720.webp", quality=90)
+    if not restore_thumbnails(cache_dir, key, thumbnails):
+        with Image.open(image_file) as img:
+            img.thumbnail(fit_width(img, 1920))
+            img = convert_for_webp(img)
+            img.save(thumbnails[""], **WEBP_OPTIONS)
+            # crop and resize in a single pass
+            crop = calculate_crop(img, gravity)
+            size = min(crop[2] - crop[0], 720)
+            img = img.resize((size, size), box=crop, reducing_gap=2.0)
+            img.save(thumbnails["-w720"], **WEBP_OPTIONS)
+
+        store_thumbnails(cache_dir, key, thumbnails)
 
     image_file.unlink()
 
+    return key
+
+
+
+def _generate_article_thumbnails(image_file, cache_dir):
+    try:
+        return generate_article_thumbnails(image_file, cache_dir)
+    except FileNotFoundError:
+        return None
+
+
+def _generate_banner_thumbnails(image_file, gravity, cache_dir):
+    try:
+        return generate_banner_thumbnails(image_file, gravity, cache_dir)
+    except FileNotFoundError:
+        return None
+
 
+def extract_image_urls(tokens):
+    for token in tokens:
+        if token["type"] == "image":
+            # the url is HTML-escaped and percent-encoded by mistune
+            yield unquote(html.unescape(token["attrs"]["url"]))
+        elif "children" in token:
+            yield from extract_image_urls(token["children"])
 
-def transform_pages(site):
+
+def transform_pages(site, cache_dir):
     markdown = create_markdown(
         renderer=CustomRenderer(escape=False),
         plugins=(
@@ -196,34 +352,50 @@ def transform_pages(site):
         ),
     )
 
-    for page in site.pages:
-        if page.content:
-            parent_dir = page.src.parent
-
-            extracted_image_files = RE_EXTRACT_IMAGES.findall(page.content)
-            for rel_file in extracted_image_files:
-                file = parent_dir / rel_file
-                try:
-                    generate_article_thumbnails(file)
-                except FileNotFoundError:
-                    pass
+    # images are independent of each other, convert them in parallel while rendering,
+    # paths are resolved so that no two workers process the same file
+    image_files = set()
+    futures = []
 
-        page.content = markdown(page.content)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for page in site.pages:
+            # rendering fills in inline tokens, so images can be read from the state
+            page.content, state = markdown.parse(page.content)
+            if not page.src:
+                continue
 
-        if page.custom:
             parent_dir = page.src.parent
 
-            for feature in page.custom.get("features") or {}:
-                banner = feature.get("banner")
-                banner_gravity = feature.get("banner_gravity")
-                if not banner:
-                    continue
-
-                file = parent_dir / banner
-                try:
-                    generate_banner_thumbnails(file, banner_gravity)
-                except FileNotFoundError:
-                    pass
+            for rel_file in extract_image_urls(state.tokens):
+                file = (parent_dir / rel_file).resolve()
+                if file not in image_files:
+                    image_files.add(file)
+                    futures.append(
+                        executor.submit(_generate_article_thumbnails, file, cache_dir)
+                    )
+
+            if page.custom:
+                for feature in page.custom.get("features") or {}:
+                    banner = feature.get("banner")
+                    banner_gravity = feature.get("banner_gravity")
+                    if not banner:
+                        continue
+
+                    file = (parent_dir / banner).resolve()
+                    if file not in image_files:
+                        image_files.add(file)
+                        futures.append(
+                            executor.submit(
+                                _generate_banner_thumbnails,
+                                file,
+                                banner_gravity,
+                                cache_dir,
+                            )
+                        )
+
+        used_keys = {future.result() for future in futures}
+
+    prune_thumbnail_cache(cache_dir, used_keys)
 
 
 def get_page_context(site, page):
@@ -237,10 +409,9 @@ def export_pages(site, templates_dir):
         if not page.src:
             continue
 
-        with open(page.dst, "w") as dst:
-            context = get_page_context(site, page)
-            output = template.render(**context)
-            dst.write(output)
+        context = get_page_context(site, page)
+        output = template.render(**context)
+        page.dst.write_text(output, encoding="utf-8")
 
         page.src.unlink()
 
@@ -252,7 +423,7 @@ def get_sitemap_context(site):
 def export_sitemap(site, templates_dir, output_dir):
     template = get_template(templates_dir / "sitemap.xml")
 
-    with open(output_dir / "sitemap.xml", "w") as dst:
+    with open(output_dir / "sitemap.xml", "w", encoding="utf-8") as dst:
         context = get_sitemap_context(site)
         output = template.render(**context)
         dst.write(output)
@@ -265,7 +436,7 @@ def get_feed_context(site):
 def export_feed(site, templates_dir, output_dir):
     template = get_template(templates_dir / "atom.xml")
 
-    with open(output_dir / "atom.xml", "w") as dst:
+    with open(output_dir / "atom.xml", "w", encoding="utf-8") as dst:
         context = get_feed_context(site)
         output = template.render(**context)
         dst.write(output)
@@ -280,11 +451,13 @@ def main(workspace):
     output_dir = workspace_dir / "output"
     templates_dir = workspace_dir / "templates"
     config_file = workspace_dir / "config.yml"
+    cache_dir = workspace_dir / ".cache"
 
     copy_source_to_target(input_dir, output_dir)
+    cache_dir.mkdir(exist_ok=True)
 
     site = parse_config(output_dir, config_file)
-    transform_pages(site)
+    transform_pages(site, cache_dir)
 
     export_pages(site, templates_dir)
     export_sitemap(site, templates_dir, output_dir)